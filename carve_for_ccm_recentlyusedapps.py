@@ -1,61 +1,44 @@
-from __future__ import print_function
-from builtins import bytes, chr, open
-
 #!/usr/bin/env python
 # Written by James Habben
 # Updated 2017-04-04
 
 import argparse
-from collections import namedtuple
+from array import array
+import codecs
+from concurrent.futures import ProcessPoolExecutor
+import csv
 from datetime import datetime, timedelta
-import decimal
+import heapq
+import io
+from itertools import repeat
 import mmap
-import os.path
-import re
+from operator import itemgetter
 import struct
 import sys
 import time
 
 
-if sys.version_info[0] > 2:
-    import csv
-else:
-    from backports import csv
+WINDOWS_FILETIME_EPOCH = datetime(1601, 1, 1)
 
 
-# Below two functions are updated versions of timestamp parsing from Python-Registry package,
+# Below function is an updated version of timestamp parsing from Python-Registry package,
 # which has not been updated on PyPi.
 # Copyright 2011 Will Ballenthin
 # Licensed under the Apache License, Version 2.0
 
 
-def parse_timestamp(ticks, resolution, epoch, mode=decimal.ROUND_HALF_EVEN):
-    """
-    Generalized function for parsing timestamps
-
-    :param ticks: number of time units since the epoch
-    :param resolution: number of time units per second
-    :param epoch: the datetime of this timestamp's epoch
-    :param mode: decimal rounding mode
-    :return: datetime.datetime
-    """
-    # python's datetime.datetime supports microsecond precision
-    datetime_resolution = int(1e6)
-
-    # convert ticks since epoch to microseconds since epoch
-    us = int((decimal.Decimal(ticks * datetime_resolution) / decimal.Decimal(resolution)).quantize(1, mode))
-
-    # convert to datetime
-    return epoch + timedelta(microseconds=us)
-
-
 def parse_windows_timestamp(qword):
     """
     :param qword: number of 100-nanoseconds since 1601-01-01
     :return: datetime.datetime
     """
     # see https://msdn.microsoft.com/en-us/library/windows/desktop/ms724290(v=vs.85).aspx
-    return parse_timestamp(qword, int(1e7), datetime(1601, 1, 1))
+    # python's datetime.datetime supports microsecond precision, so round the 100ns ticks
+    # half to even with integer math rather than going through decimal
+    us, remainder = divmod(qword, 10)
+    if remainder > 5 or (remainder == 5 and us & 1):
+        us += 1
+    return WINDOWS_FILETIME_EPOCH + timedelta(microseconds=us)
 
 
 def datetime_from_windows_filetime(count):
@@ -73,13 +56,24 @@ class NamedStruct(struct.Struct):
             pairs = []
         struct_args = [x[1] for x in pairs]
         super(NamedStruct, self).__init__(endianness + ' '.join(struct_args))
-        self.structured_data = namedtuple(struct_name, [x[0] for x in pairs if 'x' not in x[1]])
-
-    def parse(self, buf, offset):
-        return self.structured_data._make(self.unpack(buf[offset:self.size + offset]))
-
-    def parse_as_dict(self, buf, offset):
-        return dict(self.parse(buf, offset)._asdict())
+        self.struct_name = struct_name
+        self.field_names = tuple(x[0] for x in pairs if 'x' not in x[1])
+
+    def build_parse_into(self):
+        """
+        Generate a parse_into(buf, offset, record) function specialized for this layout, which
+        unpacks straight into the given dict without building a namedtuple or intermediate dict
+        """
+        names = ['value_{}'.format(idx) for idx in range(len(self.field_names))]
+        lines = ['def parse_into(buf, offset, record):']
+        if names:
+            lines.append('    {} = unpack_from(buf, offset)'.format(''.join(name + ', ' for name in names)))
+        else:
+            lines.append('    unpack_from(buf, offset)')
+        lines.extend('    record[{!r}] = {}'.format(field, name) for field, name in zip(self.field_names, names))
+        namespace = {'unpack_from': self.unpack_from}
+        exec('\n'.join(lines), namespace)
+        return namespace['parse_into']
 
 
 RECENTLY_USED_APPS_TYPES = {
@@ -98,6 +92,8 @@ RUA_RECORD_HEADER = NamedStruct('CIMRUA_Header', '<', [
     ('_property_states', '5x'),
 ])
 
+parse_record_header_into = RUA_RECORD_HEADER.build_parse_into()
+
 
 RUA_PROPERTY_OFFSETS_VALUES = NamedStruct('CIMRUA_Offsets', '<', [
     ('folder_path', 'I'),
@@ -155,6 +151,20 @@ RUA_RECORD_STRINGS = [
 ]
 
 
+# Positions of fields within an unpacked RUA_PROPERTY_OFFSETS_VALUES tuple, so records can be
+# filled without building an intermediate namedtuple and dict
+RUA_PROPERTY_OFFSETS_FIELDS = RUA_PROPERTY_OFFSETS_VALUES.field_names
+RUA_PROPERTY_VALUE_INDEXES = [
+    (prop_name, RUA_PROPERTY_OFFSETS_FIELDS.index(prop_name)) for prop_name in RUA_PROPERTY_VALUE_FIELDS]
+# Kept in struct order so that sorting by offset breaks ties the same way every time
+RUA_RECORD_STRING_NAMES = [
+    prop_name for prop_name in RUA_PROPERTY_OFFSETS_FIELDS if prop_name in RUA_RECORD_STRINGS]
+# Pulls all of the string offsets out of the unpacked tuple in one call
+get_record_string_offsets = itemgetter(
+    *[RUA_PROPERTY_OFFSETS_FIELDS.index(prop_name) for prop_name in RUA_RECORD_STRING_NAMES])
+RUA_PROPERTIES_SIZE_INDEX = RUA_PROPERTY_OFFSETS_FIELDS.index('properties_size')
+
+
 CSV_FIELDNAMES = [
     'input_file_path',
     'offset',
@@ -169,25 +179,49 @@ CSV_FIELDNAMES = [
 ] + RUA_RECORD_STRINGS
 
 
+# Every record starts with all fields present and unset
+RECORD_TEMPLATE = dict.fromkeys(CSV_FIELDNAMES)
+
+
+# Output is buffered and encoded in batches of rows rather than a row at a time
+CSV_BUFFER_SIZE = 1 << 20
+CSV_ROWS_PER_WRITE = 1024
+
+
 # This is an arbitrary safety limit for the parser
 RUA_MAX_RECORD_SIZE = 65536
 
 
+# Chunk size when reading without mmap. Chunks overlap by enough to hold the longest class name hash
+# plus a maximum sized record, so a hit near the end of a chunk can be parsed from the next one.
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+READ_CHUNK_OVERLAP = (max(RECENTLY_USED_APPS_TYPES) + RUA_RECORD_HEADER.size + RUA_PROPERTY_OFFSETS_VALUES.size +
+                      RUA_MAX_RECORD_SIZE)
+
+
+# Number of hits handed to a worker process at a time when decoding in parallel
+HITS_PER_WORKER_BATCH = 1024
+
+
+# Number of hits whose records are prefetched at a time, one such batch ahead of the decoder
+PREFETCH_HITS_AHEAD = 1024
+
+
 def decode_cim_encoded_string(buf, offset, uncompressed, fullpath=None, file_offset=None):
     if uncompressed:
         try:
-            return buf.decode('utf-16le', errors='replace').rstrip('\x00')
+            # str() decodes straight from a memoryview without copying it to bytes first
+            return str(buf, 'utf-16le', 'replace').rstrip('\x00')
         except Exception:
             pass
     else:
         try:
-            buf = buf.rstrip(b'\x00')
-            range_end = len(buf)
-            return ''.join([chr(buf[i]) for i in range(offset, range_end)])
+            # Each octet is the low byte of a code point from 0 to 255, which is exactly latin-1
+            return str(buf[offset:], 'latin-1').rstrip('\x00')
         except Exception:
             pass
     print("Could not decode CIM Encoded String ({}) at offset {} in file {}.".format(
-        buf, file_offset, fullpath))
+        bytes(buf), file_offset, fullpath))
     return None
 
 
@@ -214,31 +248,32 @@ def read_cim_encoded_string(buf, start, end, fullpath=None, file_offset=None):
     # Record length 2 only happens when you have a flag and null byte, no point in processing
     if end - start == 2:
         return None
-    if start > len(buf):
+    buf_len = len(buf)
+    if start >= buf_len:
         return None
-    uncompressed_raw = buf[start:start + 1]
-    if uncompressed_raw not in [b'\x00', b'\x01']:
-        print("Unexpected Encoded-String-Flag value ({}) - should have been 0x00 or 0x01 at offset {} in file {}.".format(
-            uncompressed_raw, file_offset, fullpath))
+    # Indexing gives the flag as an int, no slice object needed
+    flag = buf[start]
+    if flag > 1:
+        print("Unexpected Encoded-String-Flag value (0x{:02X}) - should have been 0x00 or 0x01 at offset {} in file {}.".format(
+            flag, file_offset, fullpath))
         return None
-    uncompressed = uncompressed_raw == b'\x01'
-    next_byte = buf[start + 1:start + 2]
-    if next_byte == b'':
+    # Flag with no characters after it, the string was truncated
+    if start + 1 >= buf_len:
         return None
-    return decode_cim_encoded_string(buf[start + 1:end], 0, uncompressed, fullpath, file_offset)
+    return decode_cim_encoded_string(buf[start + 1:end], 0, flag == 1, fullpath, file_offset)
 
 
-def get_prop_offsets(fileobj, record, fullpath, hash_start):
+def get_prop_offsets(data, offset, record, fullpath, hash_start):
     try:
-        offsets = RUA_PROPERTY_OFFSETS_VALUES.parse_as_dict(
-            fileobj.read(RUA_PROPERTY_OFFSETS_VALUES.size), 0)
+        values = RUA_PROPERTY_OFFSETS_VALUES.unpack_from(data, offset)
     except struct.error:
         print('Could not decode RUA record property offsets/values at offset {} in file {}'.format(
             hash_start, fullpath))
         return None
     # Grab the value fields
-    record.update((prop_name, offsets.pop(prop_name, None)) for prop_name in RUA_PROPERTY_VALUE_FIELDS)
-    return offsets
+    for prop_name, idx in RUA_PROPERTY_VALUE_INDEXES:
+        record[prop_name] = values[idx]
+    return values
 
 
 def parse_fields(record):
@@ -247,54 +282,275 @@ def parse_fields(record):
     folder_path = record.get('folder_path', '') or ''
     file_name = record.get('explorer_filename', '') or ''
     record['full_path'] = ''.join([folder_path, '' if folder_path.endswith('\\') else '\\', file_name]) or None
-    record['file_extension'] = os.path.splitext(file_name)[1].replace('.', '').lower() or None
+    # Same extension as ntpath.splitext() finds, without the tuple and extra copies. A dot only counts
+    # after the last path separator and when something other than dots comes before it, so
+    # '.bashrc' and 'dir.d/app' have none.
+    name_start = max(file_name.rfind('/'), file_name.rfind('\\')) + 1
+    dot = file_name.rfind('.')
+    if dot > name_start and file_name[name_start:dot].lstrip('.'):
+        record['file_extension'] = file_name[dot + 1:].lower() or None
+    else:
+        record['file_extension'] = None
     return record
 
 
-def process_hit(fileobj, match, fullpath):
-    hash_start = match.start()
-    hash_end = match.end()
+def process_hit(data, hash_start, hash_end, fullpath, base_offset=0):
+    """
+    :param data: buffer holding the record, a mapping of the whole file or a chunk of it
+    :param hash_start: offset of the class name hash in data
+    :param hash_end: offset just past the class name hash in data
+    :param fullpath: value for the input_file_path field
+    :param base_offset: file offset of the start of data, for records read from a chunk
+    :return: record dict
+    """
     match_len = hash_end - hash_start
+    file_offset = base_offset + hash_start
 
-    record = {
-        'input_file_path': fullpath,
-        'offset': hash_start,
-        'record_type': RECENTLY_USED_APPS_TYPES[match_len]
-    }
-    fileobj.seek(hash_end)
+    # Copying the template gives a dict already sized for every field
+    record = RECORD_TEMPLATE.copy()
+    record['input_file_path'] = fullpath
+    record['offset'] = file_offset
+    record['record_type'] = RECENTLY_USED_APPS_TYPES[match_len]
     try:
-        record.update(
-            RUA_RECORD_HEADER.parse_as_dict(fileobj.read(RUA_RECORD_HEADER.size), 0))
+        parse_record_header_into(data, hash_end, record)
     except struct.error:
-        print('Could not decode RUA record header at offset {} in file {}'.format(hash_start, fullpath))
+        print('Could not decode RUA record header at offset {} in file {}'.format(file_offset, fullpath))
         return record
     record_size = record.pop('record_size')
     if record_size > RUA_MAX_RECORD_SIZE:
         print('Decoded record size ({}) larger than allowed max record size ({}) at offset {} in file {}.'.format(
-            record_size, RUA_MAX_RECORD_SIZE, hash_start, fullpath))
+            record_size, RUA_MAX_RECORD_SIZE, file_offset, fullpath))
 
-    offsets = get_prop_offsets(fileobj, record, fullpath, hash_start)
-    if offsets is None:
+    offsets_start = hash_end + RUA_RECORD_HEADER.size
+    values = get_prop_offsets(data, offsets_start, record, fullpath, file_offset)
+    if values is None:
         return record
-    properties_size = offsets.pop('properties_size')
-    # future bytes() for Python 2.7 compatibility
-    properties_data = bytes(fileobj.read(min(properties_size, RUA_MAX_RECORD_SIZE)))
-
-    sorted_offsets = sorted(offsets.items(), key=lambda kv: kv[1])
-    s_o_len = len(sorted_offsets)
-    for idx, (prop_name, field_offset) in enumerate(sorted_offsets):
-        field_end = sorted_offsets[idx + 1][1] if (idx + 1 < s_o_len) else properties_size
-        record[prop_name] = read_cim_encoded_string(properties_data, field_offset, field_end, fullpath, hash_start)
+    properties_size = values[RUA_PROPERTIES_SIZE_INDEX]
+    properties_start = offsets_start + RUA_PROPERTY_OFFSETS_VALUES.size
+    # A negative size is corrupt, read up to the safety limit like an oversized one so that the
+    # result doesn't depend on how much of the file happens to be in the buffer
+    properties_len = properties_size if 0 <= properties_size <= RUA_MAX_RECORD_SIZE else RUA_MAX_RECORD_SIZE
+    properties_data = data[properties_start:properties_start + properties_len]
+
+    # sorted() is stable, so equal offsets keep their struct order
+    sorted_offsets = sorted(zip(get_record_string_offsets(values), RUA_RECORD_STRING_NAMES), key=itemgetter(0))
+    # Each string runs up to the start of the next one, the last runs to the end of the section
+    field_ends = [field_offset for field_offset, _ in sorted_offsets[1:]]
+    field_ends.append(properties_len)
+    for (field_offset, prop_name), field_end in zip(sorted_offsets, field_ends):
+        record[prop_name] = read_cim_encoded_string(properties_data, field_offset, field_end, fullpath, file_offset)
 
     record = parse_fields(record)
     return record
 
 
-def parse(fileobj, fullpath=None):
-    pattern = '7C261551B264D35E30A7FA29C75283DAE04BBA71DBE8F5E553F7AD381B406DD8|6FA62F462BEF740F820D72D9250D743C'.encode('utf-16le')
+# UTF-16LE class name hashes that precede each record
+RUA_CLASS_HASHES = [
+    '7C261551B264D35E30A7FA29C75283DAE04BBA71DBE8F5E553F7AD381B406DD8'.encode('utf-16le'),  # Vista
+    '6FA62F462BEF740F820D72D9250D743C'.encode('utf-16le'),  # XP
+]
+
+
+def find_needle(data, needle):
+    needle_len = len(needle)
+    hash_start = data.find(needle)
+    while hash_start != -1:
+        hash_end = hash_start + needle_len
+        yield hash_start, hash_end
+        hash_start = data.find(needle, hash_end)
+
+
+def find_hits(data):
+    """
+    Scan a buffer for all class name hashes
+
+    Each hash is a fixed string, so they are searched separately with find(), which uses the
+    fast substring search, and the results are merged back together.
+
+    :param data: bytes-like object (bytes, mmap)
+    :return: generator of (hash_start, hash_end) tuples in ascending offset order
+    """
+    return heapq.merge(*[find_needle(data, needle) for needle in RUA_CLASS_HASHES])
+
+
+def advise(data, advices, start=0, length=None):
+    """
+    Pass madvise() hints for a region of a mapping. madvise() is only available on Unix, elsewhere
+    and for unknown advice names this does nothing.
+
+    :param data: mmap object
+    :param advices: names of mmap.MADV_* constants
+    :param start: offset of the region to advise, rounded down to a page boundary
+    :param length: length of the region, defaults to the rest of the mapping
+    """
+    if not hasattr(data, 'madvise'):
+        return
+    if length is None:
+        length = len(data) - start
+    page_start = start - start % mmap.PAGESIZE
+    length += start - page_start
+    for advice in advices:
+        if hasattr(mmap, advice):
+            try:
+                data.madvise(getattr(mmap, advice), page_start, length)
+            except (OSError, ValueError):
+                pass
+
+
+def advise_sequential(data):
+    """
+    Hint to the kernel that the mapping will be read front to back, so it can use a larger
+    readahead window. Records are prefetched separately by prefetch_records(), asking for the
+    whole mapping up front would only evict them again on files larger than RAM.
+    """
+    advise(data, ('MADV_SEQUENTIAL',))
+
+
+def prefetch_records(data, hit_starts, hit_ends):
+    """
+    Ask the kernel to start reading the records of a batch of hits in the background, so that
+    page faults on a cold file overlap with decoding earlier records. Overlapping record windows
+    are merged to keep the number of madvise() calls down.
+
+    :param data: mmap object
+    :param hit_starts: hash start offsets in ascending order
+    :param hit_ends: the matching hash end offsets
+    """
+    window_start = window_end = None
+    for hash_start, hash_end in zip(hit_starts, hit_ends):
+        record_end = hash_end + RUA_MAX_RECORD_SIZE
+        if window_end is not None and hash_start <= window_end:
+            window_end = max(window_end, record_end)
+            continue
+        if window_end is not None:
+            advise(data, ('MADV_WILLNEED',), window_start, window_end - window_start)
+        window_start, window_end = hash_start, record_end
+    if window_end is not None:
+        advise(data, ('MADV_WILLNEED',), window_start, window_end - window_start)
+
+
+def scan_hits(data):
+    """
+    First stage of parse(): find every hit before any record is decoded, so the scan runs as one
+    tight pass over the buffer
+
+    :param data: bytes-like object (bytes, mmap)
+    :return: (hit_starts, hit_ends) arrays of offsets in ascending order
+    """
+    hit_starts = array('q')
+    hit_ends = array('q')
+    for hash_start, hash_end in find_hits(data):
+        hit_starts.append(hash_start)
+        hit_ends.append(hash_end)
+    return hit_starts, hit_ends
+
+
+def process_hits(path, hit_starts, hit_ends, fullpath=None):
+    """
+    Worker for parse(): map the file again and process a batch of hits
+
+    :param path: path of the file to open, the page cache is shared with the parent process
+    :param hit_starts: array of hash start offsets in ascending order
+    :param hit_ends: array of the matching hash end offsets
+    :param fullpath: value for the input_file_path field
+    :return: list of records
+    """
+    with open(path, 'rb') as fileobj:
+        data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        prefetch_records(data, hit_starts, hit_ends)
+        view = memoryview(data)
+        try:
+            return [process_hit(view, hash_start, hash_end, fullpath)
+                    for hash_start, hash_end in zip(hit_starts, hit_ends)]
+        finally:
+            view.release()
+            data.close()
+
+
+def parse_chunked(fileobj, fullpath=None):
+    """
+    Carve a file for CCM_RecentlyUsedApps records without mapping it, reading it in overlapping
+    chunks. Resident memory stays bounded and there is no SIGBUS risk if the file is truncated
+    underneath us, as can happen on network file systems.
+
+    :param fileobj: file object opened in binary mode
+    :param fullpath: value for the input_file_path field
+    :return: generator of records in ascending offset order
+    """
+    read_size = READ_CHUNK_SIZE + READ_CHUNK_OVERLAP
+    base_offset = 0
+    while True:
+        fileobj.seek(base_offset)
+        buf = fileobj.read(read_size)
+        last_chunk = len(buf) < read_size
+        view = memoryview(buf)
+        for hash_start, hash_end in find_hits(buf):
+            # Hits in the overlap are handled by the next chunk, where their whole record is available
+            if hash_start >= READ_CHUNK_SIZE and not last_chunk:
+                break
+            yield process_hit(view, hash_start, hash_end, fullpath, base_offset)
+        if last_chunk:
+            return
+        base_offset += READ_CHUNK_SIZE
+
+
+def parse(fileobj, fullpath=None, workers=1, use_mmap=True):
+    """
+    Carve a file for CCM_RecentlyUsedApps records
+
+    :param fileobj: file object opened in binary mode
+    :param fullpath: value for the input_file_path field
+    :param workers: number of processes used to decode hits, 1 decodes in this process
+    :param use_mmap: map the file, otherwise read it in chunks in this process (workers is ignored)
+    :return: generator of records in ascending offset order
+    """
+    if not use_mmap:
+        for record in parse_chunked(fileobj, fullpath):
+            yield record
+        return
     data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
-    for match in re.finditer(pattern, data):
-        yield process_hit(fileobj, match, fullpath)
+    advise_sequential(data)
+    hit_starts, hit_ends = scan_hits(data)
+    if workers > 1:
+        batch_bounds = range(0, len(hit_starts), HITS_PER_WORKER_BATCH)
+        executor = ProcessPoolExecutor(max_workers=workers)
+        try:
+            for records in executor.map(process_hits, repeat(fileobj.name),
+                                        [hit_starts[i:i + HITS_PER_WORKER_BATCH] for i in batch_bounds],
+                                        [hit_ends[i:i + HITS_PER_WORKER_BATCH] for i in batch_bounds],
+                                        repeat(fullpath)):
+                for record in records:
+                    yield record
+        finally:
+            # map() submits every batch up front, don't decode the rest if the caller stops early
+            executor.shutdown(cancel_futures=True)
+        return
+    # Slicing a memoryview shares the mapping instead of copying each property section
+    view = memoryview(data)
+    prefetch_records(data, hit_starts[:PREFETCH_HITS_AHEAD], hit_ends[:PREFETCH_HITS_AHEAD])
+    for idx, (hash_start, hash_end) in enumerate(zip(hit_starts, hit_ends)):
+        # Keep the kernel one batch ahead of the decoder
+        if idx % PREFETCH_HITS_AHEAD == 0:
+            next_batch = slice(idx + PREFETCH_HITS_AHEAD, idx + 2 * PREFETCH_HITS_AHEAD)
+            prefetch_records(data, hit_starts[next_batch], hit_ends[next_batch])
+        yield process_hit(view, hash_start, hash_end, fullpath)
+
+
+# Records always carry every field, unset ones are None and are written as empty cells
+record_to_row = itemgetter(*CSV_FIELDNAMES)
+
+
+def write_csv_rows(csv_file, rows):
+    """
+    Format a batch of rows as CSV in memory and write it to a binary file as UTF-8 in one call,
+    instead of sending every row through a text file's encoder
+
+    :param csv_file: file object opened in binary mode
+    :param rows: list of rows in CSV_FIELDNAMES order
+    """
+    batch = io.StringIO()
+    csv.writer(batch).writerows(rows)
+    csv_file.write(batch.getvalue().encode('utf-8'))
 
 
 def main():
@@ -303,18 +559,30 @@ def main():
     parser = argparse.ArgumentParser(description='Carve any data blob file for CCM_RecentlyUsedApps records')
     parser.add_argument('input', help='path to an OBJECTS.DATA/INDEX.BTR file')
     parser.add_argument('--csv', required=True, help='path to tab delimited output file')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes used to decode records (default: 1)')
+    parser.add_argument('--no-mmap', dest='use_mmap', action='store_false',
+                        help='read the input in chunks instead of mapping it, e.g. for files on NFS')
     if len(sys.argv) < 2:
         parser.print_usage()
         sys.exit(1)
     args = parser.parse_args()
+    if not args.use_mmap and args.workers > 1:
+        parser.error('--workers cannot be used with --no-mmap')
     hitcount = 0
 
-    with open(args.input, 'rb') as in_file, open(args.csv, 'w', encoding='utf_8_sig', newline='') as csv_file:
-        csv_writer = csv.DictWriter(csv_file, fieldnames=CSV_FIELDNAMES)
-        csv_writer.writeheader()
-        for record in parse(in_file, args.input):
-            hitcount += 1
-            csv_writer.writerow(record)
+    with open(args.input, 'rb') as in_file, open(args.csv, 'wb', buffering=CSV_BUFFER_SIZE) as csv_file:
+        csv_file.write(codecs.BOM_UTF8)
+        write_csv_rows(csv_file, [CSV_FIELDNAMES])
+        rows = []
+        for record in parse(in_file, args.input, args.workers, args.use_mmap):
+            rows.append(record_to_row(record))
+            if len(rows) == CSV_ROWS_PER_WRITE:
+                hitcount += len(rows)
+                write_csv_rows(csv_file, rows)
+                rows = []
+        hitcount += len(rows)
+        write_csv_rows(csv_file, rows)
 
         print('Hits: {}'.format(hitcount))
         print('Time elapsed: {:.2f}s'.format(time.time() - start_time))
@@ -2,11 +2,22 @@
 from __future__ import print_function
 
 
+import codecs
+import contextlib
+import csv
 from datetime import datetime
+import io
+import os
 import os.path
+import shutil
+import struct
+import sys
+import tempfile
 import unittest
+from unittest import mock
 
 
+import carve_for_ccm_recentlyusedapps
 from carve_for_ccm_recentlyusedapps import parse as parse_wmi_cim
 
 
@@ -14,6 +25,30 @@ class TestParser(unittest.TestCase):
     def setUp(self):
         self.test_dir = os.path.join(os.path.dirname(os.path.normpath(__file__)), 'test')
 
+    def write_blob(self, records, size):
+        """
+        Build a temporary file of filler bytes with test records placed at given offsets
+
+        :param records: list of (offset, test file name or bytes) tuples
+        :param size: minimum size of the file
+        :return: path to the file, removed when the test finishes
+        """
+        blob = bytearray(b'\xff' * size)
+        for offset, record in records:
+            if not isinstance(record, bytes):
+                with open(os.path.join(self.test_dir, record), 'rb') as test_file:
+                    record = test_file.read()
+            blob[offset:offset + len(record)] = record
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as blob_file:
+            blob_file.write(blob)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def parse_path(self, path, **kwargs):
+        with open(path, 'rb') as blob_file:
+            return list(parse_wmi_cim(blob_file, 'blob', **kwargs))
+
     def test_parse(self):
         # This test runs in Python 3 only
         tests = [
@@ -168,5 +203,111 @@ class TestParser(unittest.TestCase):
                 self.assertEqual(expected_count, len(records))
                 self.assertEqual(expected_records, records)
 
+    def test_parse_fields_file_extension(self):
+        tests = [
+            ('A.EXE', 'exe'),
+            ('a.', None),
+            ('.bashrc', None),
+            ('..x', None),
+            ('dir.d/app', None),
+            ('dir.d\\app', None),
+            ('dir/app.tar.gz', 'gz'),
+            ('', None),
+        ]
+        for file_name, expected_extension in tests:
+            record = carve_for_ccm_recentlyusedapps.parse_fields(
+                {'last_updated': 0, 'last_joined_sccm': 0, 'folder_path': None, 'explorer_filename': file_name})
+            self.assertEqual(expected_extension, record['file_extension'], file_name)
+
+    def test_main_csv(self):
+        # The CSV starts with a UTF-8 BOM and a header row, uses CRLF line endings, quotes fields with
+        # commas or quotes, and writes unset fields as empty cells
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        input_path = os.path.join(temp_dir, 'OBJECTS, "copy".DATA')
+        shutil.copyfile(os.path.join(self.test_dir, 'OBJECTS_B5FBCAh_1DEh.DATA'), input_path)
+        csv_path = os.path.join(temp_dir, 'out.csv')
+        with mock.patch.object(sys, 'argv', ['carve_for_ccm_recentlyusedapps.py', input_path, '--csv', csv_path]), \
+                contextlib.redirect_stdout(io.StringIO()):
+            carve_for_ccm_recentlyusedapps.main()
+        with open(csv_path, 'rb') as csv_file:
+            output = csv_file.read()
+
+        self.assertTrue(output.startswith(codecs.BOM_UTF8))
+        text = output[len(codecs.BOM_UTF8):].decode('utf-8')
+        self.assertTrue(text.endswith('\r\n'))
+        self.assertEqual(text.count('\n'), text.count('\r\n'))
+        lines = text.split('\r\n')
+        self.assertEqual(','.join(carve_for_ccm_recentlyusedapps.CSV_FIELDNAMES), lines[0])
+        self.assertTrue(lines[1].startswith('"{}",'.format(input_path.replace('"', '""'))))
+
+        rows = list(csv.reader(io.StringIO(text, newline='')))
+        self.assertEqual(2, len(rows))
+        row = dict(zip(rows[0], rows[1]))
+        self.assertEqual(input_path, row['input_file_path'])
+        self.assertEqual('7z1805-x64_汉语_漢語_中文.exe', row['explorer_filename'])
+        self.assertEqual('2018-06-18 20:38:48.565625', row['last_updated'])
+        self.assertEqual('1438086', row['file_size'])
+        self.assertEqual('', row['additional_product_codes'])
+
+    def test_parse_workers(self):
+        # Decoding in worker processes must give the same records, in offset order across batches
+        path = self.write_blob([(offset, file_name) for offset, file_name in zip(
+            range(100, 10000, 1000),
+            ['OBJECTS_B5FBCAh_1DEh.DATA', 'CCM_RecentlyUsedApps_0.bin', 'OBJECTS_AEDCF4h_1CEh.DATA'] * 4)], 10000)
+        expected_records = self.parse_path(path)
+        self.assertEqual(list(range(100, 10000, 1000)), [record['offset'] for record in expected_records])
+        with mock.patch.object(carve_for_ccm_recentlyusedapps, 'HITS_PER_WORKER_BATCH', 2):
+            records = self.parse_path(path, workers=3)
+        self.assertEqual(expected_records, records)
+
+    def test_parse_no_mmap(self):
+        # Reading in chunks must give the same records as mapping the file
+        for file_name in ['CCM_RecentlyUsedApps_0.bin', 'CCM_RecentlyUsedApps_0_0h_1A9h.bin', 'OBJECTS_AEDCF4h_1CEh.DATA']:
+            with open(os.path.join(self.test_dir, file_name), 'rb') as test_file:
+                expected_records = list(parse_wmi_cim(test_file, file_name))
+            with open(os.path.join(self.test_dir, file_name), 'rb') as test_file:
+                records = list(parse_wmi_cim(test_file, file_name, use_mmap=False))
+            self.assertEqual(expected_records, records)
+
+    def test_parse_chunk_boundaries(self):
+        # With small chunks: a record straddling a boundary, a hit exactly on a boundary and a hit in
+        # the overlap must each be parsed once, from the chunk that holds the whole record
+        chunk_size = 4096
+        offsets = [
+            1000,
+            chunk_size - 60,  # straddles the first boundary
+            2 * chunk_size,  # exactly on a boundary
+            3 * chunk_size + 200,  # in the overlap of the chunk before it
+        ]
+        file_names = ['OBJECTS_B5FBCAh_1DEh.DATA', 'CCM_RecentlyUsedApps_0.bin', 'OBJECTS_AEDCF4h_1CEh.DATA',
+                      'CCM_RecentlyUsedApps_0_0h_1BBh.bin']
+        # Large enough that the chunks holding these hits are not the last one
+        path = self.write_blob(list(zip(offsets, file_names)),
+                               4 * chunk_size + carve_for_ccm_recentlyusedapps.READ_CHUNK_OVERLAP * 2)
+        expected_records = self.parse_path(path)
+        self.assertEqual(offsets, [record['offset'] for record in expected_records])
+        with mock.patch.object(carve_for_ccm_recentlyusedapps, 'READ_CHUNK_SIZE', chunk_size):
+            records = self.parse_path(path, use_mmap=False)
+        self.assertEqual(expected_records, records)
+
+    def test_parse_negative_properties_size(self):
+        # A corrupt negative properties_size must not decode past RUA_MAX_RECORD_SIZE, and must give
+        # the same record whether the file is mapped or read in chunks
+        with open(os.path.join(self.test_dir, 'CCM_RecentlyUsedApps_0.bin'), 'rb') as test_file:
+            record = bytearray(test_file.read())
+        properties_size_offset = (max(carve_for_ccm_recentlyusedapps.RECENTLY_USED_APPS_TYPES) +
+                                  carve_for_ccm_recentlyusedapps.RUA_RECORD_HEADER.size +
+                                  carve_for_ccm_recentlyusedapps.RUA_PROPERTY_OFFSETS_VALUES.size - 4)
+        struct.pack_into('<h', record, properties_size_offset, -1)
+        path = self.write_blob([(0, bytes(record))], 1000000)
+        expected_records = self.parse_path(path)
+        self.assertEqual(1, len(expected_records))
+        self.assertLessEqual(len(expected_records[0]['software_properties_hash']),
+                             carve_for_ccm_recentlyusedapps.RUA_MAX_RECORD_SIZE)
+        with mock.patch.object(carve_for_ccm_recentlyusedapps, 'READ_CHUNK_SIZE', 4096):
+            records = self.parse_path(path, use_mmap=False)
+        self.assertEqual(expected_records, records)
+
 if __name__ == '__main__':
     unittest.main()